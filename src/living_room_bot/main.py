@@ -1,12 +1,22 @@
+import asyncio
 import click
 import discord
 import datetime
+import logging
+from typing import Optional
 
-import apscheduler.jobstores.memory
-import apscheduler.schedulers.asyncio
-import apscheduler.schedulers.base
-import apscheduler.triggers.interval
-import apscheduler.triggers.date
+# Discord's bulk delete endpoint accepts at most this many messages per call, and
+# only messages younger than the bulk delete age limit. It also requires the
+# Manage Messages permission, even for the bot's own messages.
+_BULK_DELETE_LIMIT = 100
+_BULK_DELETE_MAX_AGE = datetime.timedelta(days=14)
+# Messages that can't be bulk deleted are deleted individually, this many at a
+# time, to stay inside the per-channel message delete rate limit.
+_SINGLE_DELETE_BATCH = 5
+
+_ANNOUNCEMENT = "Someone's in the living room!"
+
+_LOG = logging.getLogger(__name__)
 
 
 class ChannelNotFoundError(Exception):
@@ -14,13 +24,17 @@ class ChannelNotFoundError(Exception):
 
 
 class _LivingRoomClient(discord.Client):
+    _ALLOWED = discord.AllowedMentions(
+        users=True, roles=False, everyone=False, replied_user=False
+    )
+
     def __init__(
         self,
         text_id: int,
         voice_id: int,
         gc_after: datetime.timedelta,
         gc_horizon: datetime.timedelta,
-        sched: apscheduler.schedulers.base.BaseScheduler,
+        gc_frequency: datetime.timedelta,
         debounce_period: datetime.timedelta,
         *args,
         **kwargs,
@@ -30,76 +44,186 @@ class _LivingRoomClient(discord.Client):
         self._text_id = text_id
         self._gc_after = gc_after
         self._gc_horizon = gc_horizon
-        self._sched = sched
+        self._gc_frequency = gc_frequency
+        self._gc_task: Optional[asyncio.Task] = None
+        # Id of the newest message a previous GC pass has already dealt with.
+        self._gc_cursor: Optional[int] = None
         self._debounce_period = debounce_period
+        self._pending: dict[int, asyncio.TimerHandle] = {}
+        # Announcement tasks, referenced until they finish so they can't be
+        # garbage collected mid-send.
+        self._announcements: set[asyncio.Task] = set()
+        # Resolved in on_ready.
+        self.text_channel: discord.TextChannel
+        # Set if on_ready found the configured channels unusable and shut down.
+        self.startup_error: Optional[ChannelNotFoundError] = None
 
-    @property
-    def text_channel(self) -> discord.TextChannel:
-        c = self.get_channel(self._text_id)
+    def _get_channel_or_raise(self, channel_id: int, channel_type: type):
+        c = self.get_channel(channel_id)
         if not c:
-            raise ChannelNotFoundError(f"Did not find channel with id {self._text_id}")
+            raise ChannelNotFoundError(f"Did not find channel with id {channel_id}")
+        if not isinstance(c, channel_type):
+            raise ChannelNotFoundError(
+                f"Channel with id {channel_id} is not a {channel_type.__name__}"
+            )
         return c
 
+    async def on_ready(self):
+        try:
+            self._get_channel_or_raise(self._voice_id, discord.VoiceChannel)
+            self.text_channel = self._get_channel_or_raise(
+                self._text_id, discord.TextChannel
+            )
+        except ChannelNotFoundError as e:
+            _LOG.error("%s, shutting down", e)
+            self.startup_error = e
+            await self.close()
+            return
+        # on_ready fires again after every reconnect; only start one GC loop.
+        if not self._gc_task:
+            self._gc_task = self.loop.create_task(_periodic(self, self._gc_frequency))
+
     async def on_voice_state_update(
         self,
         member: discord.Member,
         before: discord.VoiceState,
         after: discord.VoiceState,
     ):
-        if after.channel:
-            user_changed_channels = after.channel != before.channel
-            only_person_in_channel = len(after.channel.members) == 1
-            in_living_room = after.channel.id == self._voice_id
-            if user_changed_channels and only_person_in_channel and in_living_room:
-                bounce_check_time = (
-                    datetime.datetime.now(tz=datetime.timezone.utc)
-                    + self._debounce_period
-                )
-                self._sched.add_job(
-                    func=self.check_debounce,
-                    trigger=apscheduler.triggers.date.DateTrigger(bounce_check_time),
-                    args=[member, after.channel],
-                )
+        channel = after.channel
+        if channel is None or channel.id != self._voice_id:
+            # If they left the living room before their debounce expired there
+            # is nothing left to check.
+            self._cancel_debounce(member.id)
+            return
+        user_changed_channels = channel != before.channel
+        only_person_in_channel = len(channel.voice_states) == 1
+        if user_changed_channels and only_person_in_channel:
+            self._cancel_debounce(member.id)
+            self._pending[member.id] = asyncio.get_running_loop().call_later(
+                self._debounce_period.total_seconds(),
+                self._debounce_expired,
+                member,
+                channel,
+            )
+
+    def _cancel_debounce(self, member_id: int):
+        handle = self._pending.pop(member_id, None)
+        if handle:
+            handle.cancel()
+
+    def _debounce_expired(self, member: discord.Member, channel: discord.VoiceChannel):
+        self._pending.pop(member.id, None)
+        if self._should_announce(member, channel):
+            task = self.loop.create_task(self._announce())
+            self._announcements.add(task)
+            task.add_done_callback(self._announcements.discard)
 
     async def clean_up_old_notifications(self):
-        start_time = (
-            datetime.datetime.now(tz=datetime.timezone.utc) - self._gc_horizon
-        ).replace(tzinfo=None)
-        gc_horizon = (
-            datetime.datetime.now(tz=datetime.timezone.utc) - self._gc_after
-        ).replace(tzinfo=None)
-        async for message in self.text_channel.history(limit=1000, after=start_time):
-            if message.author == self.user and message.created_at < gc_horizon:
-                await message.delete()
-
-    async def check_debounce(
-        self, member: discord.Member, channel: discord.VoiceChannel
-    ):
-        if member in channel.members:
-            await self.text_channel.send(f"Someone's in the living room!")
+        # discord.py 1.x deals in naive datetimes representing UTC, both for
+        # message.created_at and for history() bounds.
+        now = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+        start_time = now - self._gc_horizon
+        gc_horizon = now - self._gc_after
+        # Snowflake ids encode their creation time, so comparing ids against
+        # these is equivalent to comparing creation times.
+        gc_snowflake = discord.utils.time_snowflake(gc_horizon)
+        bulk_delete_snowflake = discord.utils.time_snowflake(now - _BULK_DELETE_MAX_AGE)
+        my_id = self.user.id
+        channel = self.text_channel
+        # Without Manage Messages the bot can still delete its own messages one
+        # at a time.
+        can_bulk_delete = channel.permissions_for(channel.guild.me).manage_messages
+        # Resume after the last message we already handled, unless it has
+        # fallen out of the window we look back over.
+        cursor = self._gc_cursor
+        if cursor is not None and cursor >= discord.utils.time_snowflake(start_time):
+            after = discord.Object(id=cursor)
+        else:
+            after = start_time
+        last_seen = None
+        failed: list[int] = []
+        to_delete = []
+        individually = []
+        async for message in channel.history(
+            limit=None, after=after, oldest_first=True
+        ):
+            # History is walked oldest first, so once we reach the GC horizon
+            # nothing further is old enough to delete.
+            message_id = message.id
+            if message_id >= gc_snowflake:
+                break
+            last_seen = message_id
+            if message.author.id == my_id:
+                if not can_bulk_delete or message_id < bulk_delete_snowflake:
+                    individually.append(message)
+                    if len(individually) == _SINGLE_DELETE_BATCH:
+                        failed += await self._delete_individually(individually)
+                        individually = []
+                    continue
+                to_delete.append(message)
+                if len(to_delete) == _BULK_DELETE_LIMIT:
+                    await channel.delete_messages(to_delete)
+                    to_delete = []
+        if to_delete:
+            await channel.delete_messages(to_delete)
+        if individually:
+            failed += await self._delete_individually(individually)
+        if failed:
+            # Stop just short of the oldest message we failed to delete so the
+            # next pass retries it.
+            self._gc_cursor = min(failed) - 1
+        elif last_seen is not None:
+            self._gc_cursor = last_seen
 
+    async def _delete_individually(self, messages: list[discord.Message]) -> list[int]:
+        """Deletes messages concurrently, returning the ids that failed."""
+        results = await asyncio.gather(
+            *(message.delete() for message in messages), return_exceptions=True
+        )
+        failed = []
+        for message, result in zip(messages, results):
+            if isinstance(result, discord.NotFound):
+                # Already gone, which is what we wanted.
+                continue
+            if isinstance(result, discord.HTTPException):
+                _LOG.warning("Failed to delete message %d: %s", message.id, result)
+                failed.append(message.id)
+            elif isinstance(result, BaseException):
+                raise result
+        return failed
 
-_CLIENT = None
+    def _should_announce(
+        self, member: discord.Member, channel: discord.VoiceChannel
+    ) -> bool:
+        return member.id in channel.voice_states
 
+    async def _announce(self):
+        try:
+            await self.text_channel.send(_ANNOUNCEMENT, allowed_mentions=self._ALLOWED)
+        except discord.HTTPException:
+            _LOG.exception("Failed to announce in channel %d", self._text_id)
 
-def get_client(*args, **kwargs) -> _LivingRoomClient:
-    global _CLIENT
-    if not _CLIENT:
-        _CLIENT = _LivingRoomClient(
-            intents=discord.Intents(voice_states=True, guilds=True),
-            *args,
-            **kwargs,
-        )
-    return _CLIENT
 
+async def _periodic(client: _LivingRoomClient, frequency: datetime.timedelta):
+    while True:
+        await asyncio.sleep(frequency.total_seconds())
+        # Any failure, including network errors that aren't HTTPExceptions,
+        # only skips this pass; cancellation still propagates.
+        try:
+            await client.clean_up_old_notifications()
+        except Exception:
+            _LOG.exception("Failed to clean up old notifications")
 
-def make_scheduler(*args, **kwargs):
-    jobstores = {
-        "default": apscheduler.jobstores.memory.MemoryJobStore(*args, **kwargs)
-    }
-    scheduler = apscheduler.schedulers.asyncio.AsyncIOScheduler(jobstores=jobstores)
-    scheduler.start()
-    return scheduler
+
+def get_client(*args, **kwargs) -> _LivingRoomClient:
+    return _LivingRoomClient(
+        intents=discord.Intents(voice_states=True, guilds=True),
+        member_cache_flags=discord.MemberCacheFlags.none(),
+        chunk_guilds_at_startup=False,
+        max_messages=None,
+        *args,
+        **kwargs,
+    )
 
 
 @click.command()
@@ -122,7 +246,10 @@ def make_scheduler(*args, **kwargs):
     envvar="TEXT_CHANNEL_ID",
     type=int,
     required=True,
-    help="Int ID of the text channel to post notifications in",
+    help=(
+        "Int ID of the text channel to post notifications in. Old notifications "
+        "are bulk deleted if the bot has Manage Messages there"
+    ),
 )
 @click.option(
     "--message_gc_frequency",
@@ -161,24 +288,17 @@ def run(
     message_gc_after: int,
     debounce_period: int,
 ):
-    sched = make_scheduler()
     client = get_client(
         text_id=text_id,
         voice_id=voice_id,
         gc_after=datetime.timedelta(seconds=message_gc_after),
         gc_horizon=datetime.timedelta(seconds=message_gc_horizon),
-        sched=sched,
+        gc_frequency=datetime.timedelta(seconds=message_gc_frequency),
         debounce_period=datetime.timedelta(seconds=debounce_period),
     )
-    sched.add_job(
-        func=client.clean_up_old_notifications,
-        trigger=apscheduler.triggers.interval.IntervalTrigger(
-            seconds=message_gc_frequency,
-        ),
-        args=[],
-        id="periodic_garbage_collect",
-    )
     client.run(discord_bot_token)
+    if client.startup_error:
+        raise click.ClickException(str(client.startup_error))
 
 
 if __name__ == "__main__":